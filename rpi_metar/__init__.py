@@ -1,12 +1,19 @@
 import logging
 import logging.handlers
-import pkg_resources
 import socket
+from importlib.metadata import version, PackageNotFoundError
+
+
+def get_version():
+    try:
+        return version('rpi_metar')
+    except PackageNotFoundError:
+        return 'unknown'
 
 
 class ContextFilter(logging.Filter):
     hostname = socket.gethostname()
-    version = pkg_resources.get_distribution('rpi_metar').version
+    version = get_version()
 
     def filter(self, record):
         record.hostname = ContextFilter.hostname
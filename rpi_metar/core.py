@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 import enum
 
-import requests
 import logging
 import logging.handlers
 import os
@@ -39,7 +38,7 @@ AIRPORTS = {}
 
 def is_internet_up():
     try:
-        response = requests.get('http://google.com', timeout=10.0)
+        response = sources.SESSION.get('http://google.com', timeout=10.0)
         response.raise_for_status()
     except:  # noqa
         return False
@@ -1,17 +1,35 @@
 import csv
+import functools
 import logging
+import os
 import re
 import requests
-import time
-import asyncio
-from pyppeteer import launch
+import threading
+import urllib3
+from concurrent.futures import ThreadPoolExecutor
 
-from pkg_resources import resource_filename
+from lxml import etree, html
+from requests.adapters import HTTPAdapter
 from retrying import retry
-from xmltodict import parse as parsexml
 
 log = logging.getLogger(__name__)
 
+# A single, long lived session lets urllib3 pool connections and reuse TLS sessions across
+# queries, rather than paying for a new handshake on every request.
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=0))
+
+
+@functools.lru_cache(maxsize=None)
+def load_airport_coordinates():
+    """Returns a mapping of airport code to (lat, lon), read once from the bundled CSV."""
+    file_name = os.path.join(os.path.dirname(__file__), 'data', 'us-airports.csv')
+    with open(file_name, newline='') as csvfile:
+        return {
+            airport_code: (float(lat), float(lon))
+            for airport_code, lat, lon in csv.reader(csvfile)
+        }
+
 
 def chunks(l, n):
     """Yield successive n-sized chunks from l."""
@@ -19,22 +37,90 @@ def chunks(l, n):
         yield l[i:i + n]
 
 
+def is_network_error(exception):
+    """Whether an exception came from the connection rather than from the data, and so is worth
+    retrying."""
+    return isinstance(exception, (requests.RequestException, urllib3.exceptions.HTTPError))
+
+
 class METARSource:
 
-    @retry(wait_exponential_multiplier=1000,
-           wait_exponential_max=10000,
-           stop_max_attempt_number=10)
-    def _query(self):
+    # How many URLs to remember responses (and their validators) for.
+    CACHE_SIZE = 32
+
+    # Sources are recreated on every refresh, so the cache lives on the class. It maps a url to
+    # (conditional request headers, parsed result).
+    _cache = {}
+    _cache_lock = threading.Lock()
+
+    def _query(self, url, stream=False, headers=None):
         """Queries the NOAA METAR service."""
-        log.info(self.url)
+        log.info(url)
+        response = None
         try:
-            response = requests.get(self.url, timeout=10.0)
+            response = SESSION.get(url, timeout=10.0, stream=stream, headers=headers)
             response.raise_for_status()
         except:  # noqa
             log.exception('Metar query failure.')
+            # A streamed body is never read on this path, so hand the connection back now.
+            if response is not None:
+                response.close()
             raise
         return response
 
+    @retry(wait_exponential_multiplier=1000,
+           wait_exponential_max=10000,
+           stop_max_attempt_number=10,
+           retry_on_exception=is_network_error)
+    def _fetch(self, url, parse, stream=False, headers=None):
+        """Queries the url and parses the response, returning (response, result).
+
+        A streamed body is only read while parsing, so the query and the parse are retried
+        together. A 304 to a conditional query has no body to parse, and its result is None.
+        """
+        response = self._query(url, stream=stream, headers=headers)
+        if response.status_code == 304:
+            response.close()
+            if not headers:
+                # Nothing cached was offered for revalidation, so there is nothing to fall back on.
+                log.error('Metar response is invalid: 304 to an unconditional query.')
+                raise ValueError('Unexpected 304 for {}.'.format(url))
+            return response, None
+        return response, parse(response)
+
+    def _cached_query(self, url, parse, stream=False):
+        """Returns parse(response) for the url, reusing the previous result when unchanged.
+
+        Repeat queries are revalidated with If-None-Match / If-Modified-Since, and a 304 reuses
+        the old result without downloading or parsing a body.
+        """
+        with self._cache_lock:
+            cached = self._cache.get(url)
+
+        headers = {}
+        if cached is not None:
+            headers, result = cached
+
+        response, parsed = self._fetch(url, parse, stream=stream, headers=headers)
+        if cached is not None and response.status_code == 304:
+            headers = dict(headers)
+        else:
+            result = parsed
+            headers = {}
+
+        if 'ETag' in response.headers:
+            headers['If-None-Match'] = response.headers['ETag']
+        if 'Last-Modified' in response.headers:
+            headers['If-Modified-Since'] = response.headers['Last-Modified']
+
+        with self._cache_lock:
+            self._cache.pop(url, None)
+            self._cache[url] = (headers, result)
+            while len(self._cache) > self.CACHE_SIZE:
+                del self._cache[next(iter(self._cache))]
+
+        return result
+
 
 class NOAA(METARSource):
 
@@ -45,36 +131,71 @@ class NOAA(METARSource):
         '&format=xml'
         '&hoursBeforeNow=2'
         '&mostRecentForEachStation=true'
-        '&stationString={airport_codes}'
+        '&stationString='
     )
 
+    # How many chunks may be requested concurrently.
+    MAX_WORKERS = 4
+
+    # The most recently parsed METAR for each station, keyed by station id, along with its
+    # observation time and raw text: {station_id: ((observation_time, raw_text), metar)}.
+    _last_seen = {}
+
     def __init__(self, airport_codes, subdomain='www', **kwargs):
-        self.airport_codes = airport_codes
+        self.airport_codes = [code.upper() for code in airport_codes]
         self.subdomain = subdomain
 
+        # NOAA can only handle so much at once, so split into chunks.
+        # Even though we can issue larger chunk sizes, sometimes data is missing from the returned
+        # results. Smaller chunks seem to help...
+        url_prefix = self.URL.format(subdomain=self.subdomain)
+        self.urls = tuple(url_prefix + ','.join(chunk) for chunk in chunks(self.airport_codes, 250))
+
+    def _get_chunk(self, url):
+        """Retrieves and parses the METARs for a single chunk of airport codes."""
+        return self._cached_query(url, self._parse_metars, stream=True)
+
+    def _parse_metars(self, response):
+        # Only a handful of fields are needed from each METAR, so stream the (gzip decoded) body
+        # through the parser and discard each element once it has been read rather than holding
+        # the compressed bytes, the decoded text and the whole tree at once.
+        response.raw.decode_content = True
+        metars = []
+        try:
+            for _, elem in etree.iterparse(response.raw, tag='METAR', remove_blank_text=True):
+                # Most stations have not reported since the last refresh; reuse what was built
+                # for them then instead of rebuilding an identical dict. A correction keeps the
+                # observation time, so the raw text has to match as well.
+                station_id = elem.findtext('station_id')
+                seen = (elem.findtext('observation_time'), elem.findtext('raw_text'))
+                last_seen, metar = self._last_seen.get(station_id, (None, None))
+                if None in seen or seen != last_seen:
+                    metar = {child.tag: child.text for child in elem}
+                    self._last_seen[station_id] = (seen, metar)
+                metars.append(metar)
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+
+            # An empty result (or an <errors> document) is a failed query, not a successful one.
+            if not metars:
+                raise ValueError('No METARs in response.')
+        except:  # noqa
+            log.exception('Metar response is invalid.')
+            raise
+        finally:
+            response.close()
+        return metars
+
     def get_metar_info(self):
         """Queries the NOAA METAR service."""
         metars = {}
 
-        # NOAA can only handle so much at once, so split into chunks.
-        # Even though we can issue larger chunk sizes, sometimes data is missing from the returned
-        # results. Smaller chunks seem to help...
-        for chunk in chunks(self.airport_codes, 250):
-            self.url = self.URL.format(airport_codes=','.join(chunk), subdomain=self.subdomain)
-            response = self._query()
-            try:
-                response = parsexml(response.text)['response']['data']['METAR']
-                if not isinstance(response, list):
-                    response = [response]
-            except:  # noqa
-                log.exception('Metar response is invalid.')
-                raise
-            finally:
-                # ...but with more requests, we should be nice and wait a bit before the next
-                time.sleep(1.0)
-
-            for m in response:
-                metars[m['station_id'].upper()] = m
+        # With more requests, we should be nice and limit how many are in flight at once.
+        with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
+            for response in executor.map(self._get_chunk, self.urls):
+                for m in response:
+                    metars[m['station_id']] = m
 
         return metars
 
@@ -95,21 +216,17 @@ class SkyVector(METARSource):
     )
 
     def _find_coordinates(self):
-        data = {}
-        file_name = resource_filename('rpi_metar', 'data/us-airports.csv')
-        with open(file_name, newline='') as csvfile:
-            reader = csv.reader(csvfile)
-            for row in reader:
-                airport_code, lat, lon = row
-                if airport_code in self.airport_codes:
-                    data[airport_code] = (lat, lon)
+        # The sources are recreated on every refresh, but the CSV is only parsed once per process.
+        coordinates = load_airport_coordinates()
+        data = {code: coordinates[code] for code in self._codes_set if code in coordinates}
 
         self.data = data
+        if not data:
+            raise ValueError('No coordinates are known for {}.'.format(self.airport_codes))
 
-        lat1 = min((float(lat) for lat, _ in data.values()))
-        lon1 = min((float(lon) for _, lon in data.values()))
-        lat2 = max((float(lat) for lat, _ in data.values()))
-        lon2 = max((float(lon) for _, lon in data.values()))
+        lats, lons = zip(*data.values())
+        lat1, lat2 = min(lats), max(lats)
+        lon1, lon2 = min(lons), max(lons)
 
         # skyvector either isn't inclusive, or our data doesn't match theirs. Regardless, we
         # must expand the search area slightly.
@@ -121,16 +238,19 @@ class SkyVector(METARSource):
     def __init__(self, airport_codes, **kwargs):
         # Set lat / long info for the request...
         self.airport_codes = [code.upper() for code in airport_codes]
+        self._codes_set = set(self.airport_codes)
         self._find_coordinates()
 
-    def get_metar_info(self):
-        response = self._query()
+    def _parse_weather(self, response):
         try:
-            data = response.json()['weather']
+            return response.json()['weather']
         except:  # noqa
             log.exception('Metar response is invalid.')
             raise
 
+    def get_metar_info(self):
+        data = self._cached_query(self.url, self._parse_weather)
+
         """Sample response:
         [{'a': '01h 02m ago',
          'd': '2018-08-22 18:56:00',
@@ -146,8 +266,8 @@ class SkyVector(METARSource):
         # Make the return match the format of the other sources.
         metars = {}
         for item in data:
-            if item['s'] in self.airport_codes:
-                metars[item['s'].upper()] = {'raw_text': item['m']}
+            if item['s'] in self._codes_set:
+                metars[item['s']] = {'raw_text': item['m']}
 
         return metars
 
@@ -156,9 +276,10 @@ class BOM(METARSource):
     """Queries the BOM website service."""
 
     URL = 'http://www.bom.gov.au/aviation/php/process.php'
+    METAR_RE = re.compile(r'(?:METAR |SPECI )(?P<METAR>(?P<CODE>\w{4}).*?)(?:<br />|<h3>)')
 
     def __init__(self, airport_codes, **kwargs):
-        self.airport_codes = ','.join(airport_codes)
+        self.airport_codes = ','.join(code.upper() for code in airport_codes)
 
     def get_metar_info(self):
 
@@ -168,14 +289,14 @@ class BOM(METARSource):
             'page': 'TAF',
         }
 
-        r = requests.post(self.URL, data=payload)
+        r = SESSION.post(self.URL, data=payload)
 
-        matches = re.finditer(r'(?:METAR |SPECI )(?P<METAR>(?P<CODE>\w{4}).*?)(?:<br />|<h3>)', r.text)
+        matches = self.METAR_RE.finditer(r.text)
 
         metars = {}
         for match in matches:
             info = match.groupdict()
-            metars[info['CODE'].upper()] = {'raw_text': info['METAR']}
+            metars[info['CODE']] = {'raw_text': info['METAR']}
 
         return metars
 
@@ -183,12 +304,18 @@ class BOM(METARSource):
 class IFIS(METARSource):
     URL = 'https://www.ifis.airways.co.nz/script/briefing/met_briefing_proc.asp'
     LOGIN_URL = 'https://www.ifis.airways.co.nz/secure/script/user_reg/login_proc.asp'
+    METAR_RE = re.compile(r'(?:METAR |SPECI )(?P<METAR>(?P<CODE>\w{4}).*?)(?:<br/>|<h3>|=</span>|<br />)')
+    LOGIN_FORM_RE = re.compile(r'name\s*=\s*["\']?UserName\b', re.IGNORECASE)
+
+    # The data sources are recreated on every refresh, so the session (and the login cookie it
+    # holds) must outlive any one instance.
+    _session = requests.Session()
 
     # If any airport code outside of this list is used the website will throw an error (eg. MET Locations: the following locations do not issue the requested MET report types: YBBN)
     ACCEPTED_CODES = {'NZCH', 'NZCI', 'NZAA', 'NZDN', 'NZGS', 'NZHN', 'NZHK', 'NZNV', 'NZKK', 'NZMS', 'NZMF', 'NZNR', 'NZNS', 'NZNP', 'NZOU', 'NZOH', 'NZPM', 'NZPP', 'NZQN', 'NZRO', 'NZAP', 'NZTG', 'NZMO', 'NZTU', 'NZWF', 'NZWN', 'NZWS', 'NZWK', 'NZWU', 'NZWR', 'NZWP', 'NZWB'}
 
     def __init__(self, airport_codes, *, config, **kwargs):
-        self.airport_codes = ' '.join([code for code in airport_codes if code in IFIS.ACCEPTED_CODES])
+        self.airport_codes = ' '.join(code for code in map(str.upper, airport_codes) if code in IFIS.ACCEPTED_CODES)
         self.username = config['ifis']['username']
         self.password = config['ifis']['password']
         self.login_payload = {
@@ -200,57 +327,80 @@ class IFIS(METARSource):
             'MetLocations': self.airport_codes,
         }
 
-    def get_metar_info(self):
+    def _login(self):
+        r = self._session.post(self.LOGIN_URL, data=self.login_payload)
+        try:
+            r.raise_for_status()
+        except:  # noqa
+            # Don't let a failed login pass for a good session on the next refresh.
+            self._session.cookies.clear()
+            log.exception('IFIS login failure.')
+            raise
 
-        with requests.Session() as session:
-             
-            session.post(self.LOGIN_URL, data=self.login_payload)
+    def _get_briefing(self):
+        """Returns the briefing response and the METARs found in it."""
+        r = self._session.post(self.URL, data=self.data_payload)
 
-            r = session.post(self.URL, data=self.data_payload)
-            log.info(r.text)
+        metars = {}
+        for match in self.METAR_RE.finditer(r.text):
+            info = match.groupdict()
+            metars[info['CODE']] = {'raw_text': info['METAR']}
 
-        matches = re.finditer(r'(?:METAR |SPECI )(?P<METAR>(?P<CODE>\w{4}).*?)(?:<br/>|<h3>|=</span>|<br />)', r.text)
+        # The page itself is far too large to ship to syslog; a summary will do.
+        log.debug('IFIS briefing: %s bytes, %s METARs.', len(r.text), len(metars))
+        return r, metars
 
-        metars = {}
+    def _logged_out(self, r, metars):
+        """Whether a briefing request was turned away for lack of a (valid) login.
 
-        for match in matches:
-            info = match.groupdict()
-            metars[info['CODE'].upper()] = {'raw_text': info['METAR']}
+        An expired session may come back as a plain 200 serving the login form, so look for its
+        username field too. A real briefing that simply has no METARs in it is not a logout.
+        """
+        if metars:
+            return False
+        return (
+            r.status_code in (401, 403)
+            or 'login' in r.url.lower()
+            or self.LOGIN_FORM_RE.search(r.text) is not None
+        )
 
-        return metars
+    def get_metar_info(self):
 
-class KO61(METARSource):
-    URL = 'https://ko61.awos.live'
+        # None of the remaining stations are served by IFIS; don't bother asking.
+        if not self.airport_codes:
+            return {}
 
-    async def get_metar_info(self):
-        browser = await launch(executablePath='/usr/bin/chromium-browser', args=['--no-sandbox'], headless=True)
-        page = await browser.newPage()
+        # Only log in when there's no session yet, or the one we have has expired.
+        if not self._session.cookies:
+            self._login()
 
-        try:
-            await page.goto(self.URL)
-            await asyncio.sleep(1)
+        r, metars = self._get_briefing()
+        if self._logged_out(r, metars):
+            log.info('IFIS session expired, logging in again.')
+            self._login()
+            r, metars = self._get_briefing()
 
-            # Wait for the METAR data to load using the updated CSS selector
-            metar_element = await page.waitForSelector('#OfficialObs')
+        return metars
 
-            # Extract the full METAR data
-            full_metar = await page.evaluate('(element) => element.textContent', metar_element)
 
-            # Split the string by spaces and select the relevant portion starting with "KO61"
-            metar_parts = full_metar.split()
-            metar_data = ' '.join(metar_parts[metar_parts.index('KO61'):]).strip()
+class KO61(METARSource):
+    URL = 'https://ko61.awos.live'
 
-            # Return the METAR data in the specified dictionary format
-            metars = {
-                'KO61': {'raw_text': metar_data}
-            }
+    def __init__(self, airport_codes, **kwargs):
+        self.airport_codes = [code.upper() for code in airport_codes]
 
-            return metars
+    def _parse_observation(self, response):
+        return html.fromstring(response.text).get_element_by_id('OfficialObs').text_content()
 
-        except Exception as e:
-            print(f'Error: {e}')
-            return None
+    def get_metar_info(self):
+        # Read the observation straight out of the #OfficialObs element of the page rather than
+        # launching a headless browser on every refresh.
+        _, full_metar = self._fetch(self.URL, self._parse_observation)
 
-        finally:
-            await browser.close()
+        # Split the string by spaces and select the relevant portion starting with "KO61"
+        metar_parts = full_metar.split()
+        metar_data = ' '.join(metar_parts[metar_parts.index('KO61'):]).strip()
 
+        return {
+            'KO61': {'raw_text': metar_data}
+        }
@@ -42,6 +42,6 @@ setup(
             'rpi_metar_init = rpi_metar.scripts.init:main',
         ],
     },
-    python_requires='>=3',
+    python_requires='>=3.8',
     zip_safe=False,
 )